@@ -1,14 +1,14 @@
 """
 Set of functions for estimating the MT effect
 """
+from functools import lru_cache, partial
 from pathlib import Path
 
 from .. import utils
 
-import matplotlib.pyplot as plt
 import numpy as np
 from fsl.data.image import Image
-from sklearn.linear_model import LinearRegression
+from fsl.utils.path import PathError
 
 T1_VALS = {"wm": 1.0, "gm": 1.3, "csf": 4.3}
 BAND_RANGE = {
@@ -25,15 +25,24 @@ slice_in_band = np.tile(np.arange(0, 10), 6).reshape(1, 1, -1)
 slicedt = 0.059
 
 
+@lru_cache(maxsize=16)
+def _st_scale(tissue, tr):
+    """
+    Per-slice float32 factors rescaling data to the given TR, shape (60,).
+    """
+    t1 = T1_VALS[tissue]
+    slice_times = tr + (slice_in_band.ravel() * slicedt)
+    scale = (1 - np.exp(-tr / t1)) / (1 - np.exp(-slice_times / t1))
+    scale = scale.astype(np.float32)
+    scale.flags.writeable = False
+    return scale
+
+
 def slicetime_correction(image, tissue, tr):
     """
     Rescale data to the given TR to account for T1 relaxation.
     """
-    slice_times = tr + (slice_in_band * slicedt)
-    denominator = 1 - np.exp(-slice_times / T1_VALS[tissue])
-    numerator = 1 - np.exp(-tr / T1_VALS[tissue])
-    rescaled_image = image * (numerator / denominator)
-    return rescaled_image
+    return image * _st_scale(tissue, tr)
 
 
 def undo_st_correction(rescaled_image, tissue, ti):
@@ -44,8 +53,18 @@ def undo_st_correction(rescaled_image, tissue, ti):
     return descaled_image
 
 
+def _fit_line(x, y):
+    """
+    Closed-form ordinary least squares fit of y = intercept + slope * x.
+    """
+    x_mean, y_mean = x.mean(), y.mean()
+    slope = ((x - x_mean) * (y - y_mean)).sum() / ((x - x_mean) ** 2).sum()
+    intercept = y_mean - slope * x_mean
+    return intercept, slope
+
+
 def fit_linear_model(slice_means, method="separate", resolution=10000):
-    X = np.arange(0, 10, 1).reshape(-1, 1)
+    X = np.arange(0, 10, 1)
     scaling_factors = np.ones((6, 10))
     y_pred = np.zeros(shape=(resolution * 6, 1))
     if method == "separate":
@@ -56,26 +75,83 @@ def fit_linear_model(slice_means, method="separate", resolution=10000):
                 scaling_factors[band, :] = 1
                 y_pred[resolution * band : resolution * (band + 1), 0] = 0
                 continue
-            model = LinearRegression()
-            model.fit(X, y)
-            scaling_factors[band, :] = model.intercept_ / model.predict(X)
-            y_pred[resolution * band : resolution * (band + 1), 0] = model.predict(
-                X_pred
+            intercept, slope = _fit_line(X, y)
+            scaling_factors[band, :] = intercept / (intercept + slope * X)
+            y_pred[resolution * band : resolution * (band + 1), 0] = (
+                intercept + slope * X_pred[:, 0]
             )
     elif method == "together":
         X_pred = np.tile(np.arange(0, 10, 10 / resolution), 4)[..., np.newaxis]
-        y_train = np.vstack(np.split(slice_means, 6)[1:5])
-        y_train = np.nanmean(y_train, axis=0).reshape(-1, 1)
-        model = LinearRegression()
-        model.fit(X, y_train)
-        sfs = model.intercept_ / model.predict(np.tile(X, (4, 1))).flatten()
-        scaling_factors[1:5, :] = sfs.reshape(4, 10)
-        y_pred[resolution : resolution * 5] = model.predict(X_pred)
+        y_train = np.nanmean(slice_means.reshape(6, 10)[1:5], axis=0)
+        intercept, slope = _fit_line(X, y_train)
+        sfs = intercept / (intercept + slope * X)
+        scaling_factors[1:5, :] = sfs
+        y_pred[resolution : resolution * 5] = intercept + slope * X_pred
     scaling_factors[[0, 5], :] = scaling_factors[1:5, :].mean(axis=0)
-    scaling_factors = scaling_factors.flatten()
+    scaling_factors = scaling_factors.ravel()
     return scaling_factors, X_pred, y_pred
 
 
+def _subject_slice_stats(subject_dir, tissue, tr, ignore_dropouts=False):
+    """
+    Slicewise mean signal in both of a subject's masked calibration
+    images, along with slicewise WM and GM voxel counts if `tissue`
+    is "combined". Returns None if the subject can't be processed.
+    """
+    suf = "_ignoredropouts" if ignore_dropouts else ""
+    mean_array = np.zeros((60, 2))
+    count_array = np.zeros((60, 2, 2))  # wm and gm
+    try:
+        mask_dirs = [
+            subject_dir / "ASL/Calib" / c / f"SEbased_MT_t1mask{suf}/DistCorr/masks"
+            for c in ("Calib0", "Calib1")
+        ]
+        tissues = ("gm", "wm") if tissue == "combined" else (tissue,)
+        masked_names = [
+            [mask_dir / tissue / f"calib{n}_{t}_masked.nii.gz" for t in tissues]
+            for n, mask_dir in enumerate(mask_dirs)
+        ]
+        for n2, masked_name in enumerate(masked_names):
+            if tissue == "combined":
+                gm_masked, wm_masked = masked_name
+                gm_masked_data = slicetime_correction(
+                    image=Image(str(gm_masked)).data.astype(np.float32, copy=False),
+                    tissue="gm",
+                    tr=tr,
+                )
+                wm_masked_data = slicetime_correction(
+                    image=Image(str(wm_masked)).data.astype(np.float32, copy=False),
+                    tissue="wm",
+                    tr=tr,
+                )
+                masked_data = gm_masked_data + wm_masked_data
+                count_array[:, n2, 0] = np.count_nonzero(
+                    wm_masked_data > 0, axis=(0, 1)
+                )
+                count_array[:, n2, 1] = np.count_nonzero(
+                    gm_masked_data > 0, axis=(0, 1)
+                )
+            else:
+                # load masked calibration data
+                masked_data = slicetime_correction(
+                    image=Image(str(*masked_name)).data.astype(np.float32, copy=False),
+                    tissue=tissue,
+                    tr=tr,
+                )
+            # calculate slicewise mean of non-zero, non-NaN voxels
+            counts = np.count_nonzero(
+                (masked_data != 0) & ~np.isnan(masked_data), axis=(0, 1)
+            )
+            sums = np.nansum(masked_data, axis=(0, 1))
+            mean_array[:, n2] = np.divide(
+                sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0
+            )
+    except (OSError, PathError):
+        # missing or unreadable masked calibration images
+        return None
+    return mean_array, count_array
+
+
 def estimate_mt(
     subject_dirs,
     rois=[
@@ -85,64 +161,57 @@ def estimate_mt(
     method="separate",
     outdir=None,
     ignore_dropouts=False,
+    cores=1,
 ):
     """
     Estimates the slice-dependent MT effect on the given subject's
     calibration images. Performs the estimation using a linear
     model and calculates scaling factors which can be used to
-    correct the effect.
+    correct the effect. Subjects' calibration images are summarised
+    in parallel across `cores` processes.
     """
+    # plotting and multiprocessing are only needed here, so are
+    # imported lazily to keep the module cheap to import
+    import multiprocessing as mp
+    from itertools import starmap
+
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
     outdir = Path(outdir).resolve(strict=True) if outdir else Path.cwd()
     errors = []
     suf = "_ignoredropouts" if ignore_dropouts else ""
     error_free_subs = []
-    for tissue in rois:
+    # compute slicewise stats for every subject and ROI up front, using
+    # a single pool of workers (or none at all if only one core is used)
+    n_subs = len(subject_dirs)
+    subject_stats = partial(
+        _subject_slice_stats, tr=tr, ignore_dropouts=ignore_dropouts
+    )
+    jobs = [(subject_dir, tissue) for tissue in rois for subject_dir in subject_dirs]
+    if cores > 1:
+        with mp.Pool(cores) as pool:
+            all_results = pool.starmap(subject_stats, jobs)
+    else:
+        all_results = list(starmap(subject_stats, jobs))
+    # scaling factors are applied once every ROI has been fit, so that
+    # each subject's calibration image is only read once
+    roi_scaling_factors = {}
+    for n_roi, tissue in enumerate(rois):
         # initialise array to store image-level means
-        mean_array = np.zeros((60, 2 * len(subject_dirs)))
-        count_array = np.zeros((60, 2 * len(subject_dirs), 2))  # wm and gm
-        # iterate over subjects
-        for n1, subject_dir in enumerate(subject_dirs):
-            try:
-                mask_dirs = [
-                    subject_dir
-                    / "ASL/Calib"
-                    / c
-                    / f"SEbased_MT_t1mask{suf}/DistCorr/masks"
-                    for c in ("Calib0", "Calib1")
-                ]
-                tissues = ("gm", "wm") if tissue == "combined" else (tissue,)
-                masked_names = [
-                    [mask_dir / tissue / f"calib{n}_{t}_masked.nii.gz" for t in tissues]
-                    for n, mask_dir in enumerate(mask_dirs)
-                ]
-                for n2, masked_name in enumerate(masked_names):
-                    if tissue == "combined":
-                        gm_masked, wm_masked = masked_name
-                        gm_masked_data = slicetime_correction(
-                            image=Image(str(gm_masked)).data, tissue="gm", tr=tr
-                        )
-                        wm_masked_data = slicetime_correction(
-                            image=Image(str(wm_masked)).data, tissue="wm", tr=tr
-                        )
-                        masked_data = gm_masked_data + wm_masked_data
-                        gm_bin = np.where(gm_masked_data > 0, 1, 0)
-                        gm_count = np.sum(gm_bin, axis=(0, 1))[..., np.newaxis]
-                        wm_bin = np.where(wm_masked_data > 0, 1, 0)
-                        wm_count = np.sum(wm_bin, axis=(0, 1))[..., np.newaxis]
-                        count_array[:, 2 * n1 + n2, :] = np.hstack((wm_count, gm_count))
-                    else:
-                        # load masked calibration data
-                        masked_data = slicetime_correction(
-                            image=Image(str(*masked_name)).data, tissue=tissue, tr=tr
-                        )
-                    # find zero indices
-                    masked_data[masked_data == 0] = np.nan
-                    # calculate slicewise summary stats
-                    slicewise_mean = np.nanmean(masked_data, axis=(0, 1))
-                    mean_array[:, 2 * n1 + n2] = slicewise_mean
-                error_free_subs.append(subject_dir)
-            except:
+        mean_array = np.zeros((60, 2 * n_subs))
+        count_array = np.zeros((60, 2 * n_subs, 2))  # wm and gm
+        results = all_results[n_roi * n_subs : (n_roi + 1) * n_subs]
+        for n1, (subject_dir, result) in enumerate(zip(subject_dirs, results)):
+            if result is None:
                 errors.append(tissue + " " + str(subject_dir))
+                continue
+            means, counts = result
+            mean_array[:, 2 * n1 : 2 * n1 + 2] = means
+            count_array[:, 2 * n1 : 2 * n1 + 2] = counts
+            error_free_subs.append(subject_dir)
         # calculate non-zero slicewise mean of mean_array
         slice_means = np.nanmean(mean_array, axis=1)
         slice_std = np.nanstd(mean_array, axis=1)
@@ -156,7 +225,7 @@ def estimate_mt(
         # plot slicewise mean signal
         slice_numbers = np.arange(0, 60, 1)
         x_coords = np.arange(0, 60, 10)
-        plt.figure(figsize=(8, 4.5))
+        fig = plt.figure(figsize=(8, 4.5))
         plt.scatter(slice_numbers, slice_means)
         plt.errorbar(slice_numbers, slice_means, slice_std, linestyle="None", capsize=3)
         plt.ylim([0, PLOT_LIMS[tissue]])
@@ -178,10 +247,11 @@ def estimate_mt(
         plt.savefig(plt_name)
         # add linear models on top
         plt.scatter(
-            np.arange(10, 50, 0.001), y_pred.flatten()[10000:50000], color="k", s=0.1
+            np.arange(10, 50, 0.001), y_pred.ravel()[10000:50000], color="k", s=0.1
         )
         plt_name = outdir / f"{method}_{tissue}_mean_per_slice_with_lin_sebased.png"
         plt.savefig(plt_name)
+        plt.close(fig)
 
         # plot rescaled slice-means
         fig, ax = plt.subplots(figsize=(8, 4.5))
@@ -204,6 +274,7 @@ def estimate_mt(
         # save plot
         plt_name = outdir / f"{method}_{tissue}_mean_per_slice_rescaled_sebased.png"
         plt.savefig(plt_name)
+        plt.close(fig)
 
         # plot slicewise mean tissue count for WM and GM
         fig, ax = plt.subplots(figsize=(8, 4.5))
@@ -224,6 +295,7 @@ def estimate_mt(
         plt.ylabel("Mean number of voxels with PVE $\geqslant$ 70% in a given tissue")
         plt_name = outdir / f"mean_voxel_count_sebased.png"
         plt.savefig(plt_name)
+        plt.close(fig)
 
         # # the scaling factors have been estimated on images which have been
         # # slice-timing corrected - the scaling factors should hence be
@@ -234,21 +306,22 @@ def estimate_mt(
         # save scaling factors as a .txt file
         sfs_savename = outdir / f"{method}_{tissue}_scaling_factors_sebased.txt"
         np.savetxt(sfs_savename, scaling_factors, fmt="%.5f")
-        # create array from scaling_factors
-        scaling_factors = np.tile(
-            scaling_factors, (utils.ASL_SHAPE[0], utils.ASL_SHAPE[1], 1)
-        )
-        for subject_dir in subject_dirs:
-            # load bias (and possibly distortion) corrected calibration image
-            method_dir = (
-                subject_dir / f"ASL/Calib/Calib0/SEbased_MT_t1mask{suf}/DistCorr"
+        roi_scaling_factors[tissue] = scaling_factors.astype(np.float32)
+
+    for subject_dir in subject_dirs:
+        # load bias (and possibly distortion) corrected calibration image
+        method_dir = subject_dir / f"ASL/Calib/Calib0/SEbased_MT_t1mask{suf}/DistCorr"
+        calib_img = Image(str(method_dir / "calib0_restore.nii.gz"))
+        mtcorr_dir = method_dir / "MTCorr"
+        mtcorr_dir.mkdir(exist_ok=True, parents=True)
+        for tissue, scaling_factors in roi_scaling_factors.items():
+            # create and save scaling factors image, broadcasting
+            # scaling_factors to a volume view
+            scaling_vol = np.broadcast_to(
+                scaling_factors,
+                (utils.ASL_SHAPE[0], utils.ASL_SHAPE[1], scaling_factors.size),
             )
-            calib_name = method_dir / "calib0_restore.nii.gz"
-            calib_img = Image(str(calib_name))
-            # create and save scaling factors image
-            scaling_img = Image(scaling_factors, header=calib_img.header)
-            mtcorr_dir = method_dir / "MTCorr"
-            mtcorr_dir.mkdir(exist_ok=True, parents=True)
+            scaling_img = Image(scaling_vol, header=calib_img.header)
             scaling_name = mtcorr_dir / f"MTcorr_SFs_{method}_{tissue}_sebased.nii.gz"
             scaling_img.save(scaling_name)
 
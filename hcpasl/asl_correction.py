@@ -269,8 +269,9 @@ def _slicetiming_correction(asl_name, t1_name, tis, rpts, slicedt, sliceband, n_
 
     Parameters
     ----------
-    asl_name : pathlib.Path
-        Path to the ASL sequence.
+    asl_name : pathlib.Path or nb.nifti1.Nifti1Image
+        Path to the ASL sequence, or the sequence itself if it
+        is already loaded.
     t1_name : pathlib.Path
         Path to the T1 estimate. This T1 estimate can be a single
         volume or a time-series. If it is a time-series, the
@@ -305,7 +306,10 @@ def _slicetiming_correction(asl_name, t1_name, tis, rpts, slicedt, sliceband, n_
     )
     slice_times = tis_array + (slicedt * slice_numbers)
     # load images
-    asl_img = nb.load(asl_name)
+    if isinstance(asl_name, nb.nifti1.Nifti1Image):
+        asl_img = asl_name
+    else:
+        asl_img = nb.load(asl_name)
     t1_img = nb.load(t1_name)
     # check dimensions of t1 image to see if time series or not
     if t1_img.ndim == 3:
@@ -325,7 +329,7 @@ def _slicetiming_correction(asl_name, t1_name, tis, rpts, slicedt, sliceband, n_
     np.divide(num, den, out=stcorr_factors, where=(den > 0))
     stcorr_factors_img = nb.nifti1.Nifti1Image(stcorr_factors, affine=asl_img.affine)
     # correct asl series
-    stcorr_data = asl_img.get_fdata() * stcorr_factors
+    stcorr_data = asl_img.get_fdata(caching="unchanged") * stcorr_factors
     stcorr_img = nb.nifti1.Nifti1Image(stcorr_data, affine=asl_img.affine)
     return stcorr_img, stcorr_factors_img
 
@@ -568,10 +572,13 @@ def single_step_resample_to_asl0(
             axis=-1,
         )
         mt_img = nb.nifti1.Nifti1Image(mt_arr, affine=asl_corr.affine)
+        # MT factors only vary along z, so broadcast them over the 4D
+        # series rather than multiplying by the full float64 mt_arr
+        mt_sfs_zt = mt_sfs.astype(np.float32)[:, np.newaxis]
         biascorr_img = nb.load(bcorr_img)
         assert len(mt_sfs) == biascorr_img.shape[2]
         mtcorr_img = nb.nifti1.Nifti1Image(
-            (biascorr_img.get_fdata() * mt_img.get_fdata()).astype(np.float32),
+            biascorr_img.get_fdata(dtype=np.float32) * mt_sfs_zt,
             affine=biascorr_img.affine,
         )
         nb.save(mtcorr_img, mtcorr_name)
@@ -588,7 +595,7 @@ def single_step_resample_to_asl0(
     if not nobandingcorr:
         logging.info("Performing initial ST correction.")
         stcorr_img, stfactors_img = _slicetiming_correction(
-            mtcorr_name, t1_filt_name, TIS, RPTS, SLICEDT, SLICEBAND, NSLICES
+            mtcorr_img, t1_filt_name, TIS, RPTS, SLICEDT, SLICEBAND, NSLICES
         )
         stcorr_img, stfactors_img = [
             nb.nifti1.Nifti1Image(img.get_fdata().astype(np.float32), affine=img.affine)
@@ -688,11 +695,11 @@ def single_step_resample_to_asl0(
     logging.info(
         "Apply bias correction to the distortion- and motion-corrected ASL series."
     )
+    # reg_dc has already been saved, so its float32 array is divided in place
     bias_img = nb.load(bias_name)
-    reg_dc_biascorr = nb.nifti1.Nifti1Image(
-        (reg_dc.get_fdata() / bias_img.get_fdata()[..., np.newaxis]).astype(np.float32),
-        affine=reg_dc.affine,
-    )
+    reg_dc_biascorr = reg_dc.get_fdata(dtype=np.float32)
+    reg_dc_biascorr /= bias_img.get_fdata(dtype=np.float32)[..., np.newaxis]
+    reg_dc_biascorr = nb.nifti1.Nifti1Image(reg_dc_biascorr, affine=reg_dc.affine)
     reg_dc_biascorr_name = moco_dir / "reg_dc_tis_biascorr.nii.gz"
     nb.save(reg_dc_biascorr, reg_dc_biascorr_name)
 
@@ -748,7 +755,8 @@ def single_step_resample_to_asl0(
     # apply bias correction to the distortion corrected ASL series
     logging.info("Applying bias correction to the distortion corrected ASL series.")
     biascorr_dc_asl = nb.nifti1.Nifti1Image(
-        (dc_asl.get_fdata() / bias_img.get_fdata()[..., np.newaxis]).astype(np.float32),
+        dc_asl.get_fdata(dtype=np.float32)
+        / bias_img.get_fdata(dtype=np.float32)[..., np.newaxis],
         affine=dc_asl.affine,
     )
     biascorr_dc_asl_name = bcorr_dir / "tis_dc_restore.nii.gz"
@@ -759,7 +767,7 @@ def single_step_resample_to_asl0(
         # apply MT correction
         logging.info("Applying MT correction to the distortion corrected ASL series.")
         mtcorr_biascorr_dc_asl = nb.nifti1.Nifti1Image(
-            (biascorr_dc_asl.get_fdata() * mt_img.get_fdata()).astype(np.float32),
+            biascorr_dc_asl.get_fdata(dtype=np.float32) * mt_sfs_zt,
             affine=biascorr_dc_asl.affine,
         )
         mtcorr_biascorr_dc_asl_name = mtcorr_dir / "tis_dc_restore_mtcorr.nii.gz"
@@ -770,7 +778,7 @@ def single_step_resample_to_asl0(
             "Apply refined slicetiming correction to the distortion corrected ASL series."
         )
         stcorr_img, stfactors_img = _slicetiming_correction(
-            mtcorr_biascorr_dc_asl_name,
+            mtcorr_biascorr_dc_asl,
             t1_filt_asln_name,
             TIS,
             RPTS,
@@ -793,14 +801,14 @@ def single_step_resample_to_asl0(
         )
         combined_factors_name = stcorr_dir / "combined_scaling_factors_asln.nii.gz"
         combined_factors_img = nb.nifti1.Nifti1Image(
-            (stfactors_img.get_fdata() * mt_img.get_fdata()).astype(np.float32),
+            stfactors_img.get_fdata(dtype=np.float32) * mt_sfs_zt,
             affine=stfactors_img.affine,
         )
         nb.save(combined_factors_img, combined_factors_name)
         asl_corr = stcorr_name
     else:
         combined_factors_img = nb.nifti1.Nifti1Image(
-            np.ones_like(biascorr_dc_asl.get_fdata(), dtype=np.float32),
+            np.ones(biascorr_dc_asl.shape, dtype=np.float32),
             affine=biascorr_dc_asl.affine,
         )
         combined_factors_name = moco_dir / "combined_scaling_factors_asln.nii.gz"
@@ -1160,17 +1168,16 @@ def single_step_resample_to_aslt1w(
     logging.info(
         "Applying SE-based bias correction and banding corrections to ASL series."
     )
-    bias = nb.load(bias_name)
-    asl_corr = np.zeros_like(asl_dc_moco.get_fdata())
+    bias = nb.load(bias_name).get_fdata(dtype=np.float32)[..., np.newaxis]
+    asl_corr = np.zeros(asl_dc_moco.shape, dtype=np.float32)
     np.divide(
-        asl_dc_moco.get_fdata() * aslt1w_sfs.get_fdata(),
-        bias.get_fdata()[..., np.newaxis],
+        asl_dc_moco.get_fdata(dtype=np.float32)
+        * aslt1w_sfs.get_fdata(dtype=np.float32),
+        bias,
         out=asl_corr,
-        where=(bias.get_fdata()[..., np.newaxis] != 0),
-    )
-    asl_corr = nb.nifti1.Nifti1Image(
-        asl_corr.astype(np.float32), affine=asl_dc_moco.affine
+        where=(bias != 0),
     )
+    asl_corr = nb.nifti1.Nifti1Image(asl_corr, affine=asl_dc_moco.affine)
     asl_corr_name = tis_aslt1w_dir / "asl_corr.nii.gz"
     nb.save(asl_corr, asl_corr_name)
 
@@ -1257,12 +1264,19 @@ def single_step_resample_to_aslt1w(
 
         # correct the registered, gdc_dc, bias-corrected calibration image for MT effect and ST effect
         calib_biascorr = nb.load(sebased_dir / "calib0_secorr.nii.gz")
-        calib_mtcorr = nb.nifti1.Nifti1Image(
-            calib_biascorr.get_fdata()
-            * calib_mt_sfs_aslt1w.get_fdata()
-            * calib_aslt1w_stcorr_factors,
-            affine=calib_biascorr.affine,
+        calib_mtcorr = calib_biascorr.get_fdata(dtype=np.float32, caching="unchanged")
+        np.multiply(
+            calib_mtcorr,
+            calib_mt_sfs_aslt1w.get_fdata(dtype=np.float32),
+            out=calib_mtcorr,
+        )
+        np.multiply(
+            calib_mtcorr,
+            calib_aslt1w_stcorr_factors,
+            out=calib_mtcorr,
+            casting="same_kind",
         )
+        calib_mtcorr = nb.nifti1.Nifti1Image(calib_mtcorr, affine=calib_biascorr.affine)
         calib_mtcorr_name = aslt1w_dir / "Calib/Calib0/calib0_corr.nii.gz"
         nb.save(calib_mtcorr, calib_mtcorr_name)
     else:
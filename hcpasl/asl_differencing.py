@@ -54,11 +54,13 @@ def tag_control_differencing(series, scaling_factors, betas_dir, mask=None):
     # split X_perf and Y_moco into even and odd indices
     X_odd = X_perf[:, :, :, 1::2]
     X_even = X_perf[:, :, :, 0::2]
-    Y_odd = Y_moco.get_fdata()[:, :, :, 1::2]
-    Y_even = Y_moco.get_fdata()[:, :, :, 0::2]
+    Y_moco_data = Y_moco.get_fdata()
+    Y_odd = Y_moco_data[:, :, :, 1::2]
+    Y_even = Y_moco_data[:, :, :, 0::2]
 
     # ignore voxels where below would lead to dividing by zero
-    nonzero_mask = np.abs(X_odd - X_even) > 1e-6
+    X_diff = X_odd - X_even
+    nonzero_mask = np.abs(X_diff) > 1e-6
     mask_name = betas_dir / "difference_mask.nii.gz"
     nb.save(
         nb.Nifti1Image(nonzero_mask.astype(np.int32), affine=Y_moco.affine), mask_name
@@ -76,15 +78,17 @@ def tag_control_differencing(series, scaling_factors, betas_dir, mask=None):
             mask_name,
         )
 
-    # calculate B_perf and B_baseline at voxels within mask
-    B_perf, B_baseline = np.zeros_like(X_odd), np.zeros_like(X_even)
-    B_perf[nonzero_mask] = (Y_odd[nonzero_mask] - Y_even[nonzero_mask]) / (
-        X_odd[nonzero_mask] - X_even[nonzero_mask]
+    # calculate B_perf and B_baseline at voxels within mask, leaving
+    # zeros elsewhere (masked division avoids gathering every operand)
+    B_perf = np.divide(
+        Y_odd - Y_even, X_diff, out=np.zeros_like(X_diff), where=nonzero_mask
+    )
+    B_baseline = np.divide(
+        X_odd * Y_even - X_even * Y_odd,
+        X_diff,
+        out=np.zeros_like(X_diff),
+        where=nonzero_mask,
     )
-    B_baseline[nonzero_mask] = (
-        X_odd[nonzero_mask] * Y_even[nonzero_mask]
-        - X_even[nonzero_mask] * Y_odd[nonzero_mask]
-    ) / (X_odd[nonzero_mask] - X_even[nonzero_mask])
 
     # save both images
     B_perf_name = betas_dir / "beta_perf.nii.gz"
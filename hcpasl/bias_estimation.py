@@ -140,11 +140,12 @@ def bias_estimation_sebased(
     if not brain_mask.exists() or force_refresh:
         t1_brain_img = nb.load(t1_brain_name)
         t1_mask = nb.nifti1.Nifti1Image(
-            np.where(t1_brain_img.get_fdata() > 0, 1.0, 0.0), affine=t1_brain_img.affine
+            (t1_brain_img.get_fdata() > 0).astype(np.float64),
+            affine=t1_brain_img.affine,
         )
         aslt1_mask = struct2asl_reg.apply_to_image(t1_mask, calib_name, order=0)
         aslt1_mask = nb.nifti1.Nifti1Image(
-            np.where(aslt1_mask.get_fdata() > 0.5, 1.0, 0.0), affine=aslt1_mask.affine
+            (aslt1_mask.get_fdata() > 0.5).astype(np.float64), affine=aslt1_mask.affine
         )
         nb.save(aslt1_mask, brain_mask)
     # get sebased bias
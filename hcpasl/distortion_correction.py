@@ -2,6 +2,7 @@ import logging
 import os
 import os.path as op
 import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import nibabel as nb
@@ -63,7 +64,12 @@ def stack_fmaps(pa_sefm, ap_sefm, savename):
 
 
 def apply_gdc_and_topup(
-    pa_ap_sefms, topup_dir, gdc_warp, interpolation=3, gd_corr=True
+    pa_ap_sefms,
+    topup_dir,
+    gdc_warp,
+    interpolation=3,
+    gd_corr=True,
+    pa_ap_sefms_img=None,
 ):
     # load topup EPI distortion correction warps and motion correction
     topup_warps = [
@@ -100,22 +106,28 @@ def apply_gdc_and_topup(
         rt.chain(gdc_warp, topup_moco[n], topup_warps[n]) for n in range(0, 2)
     ]
 
-    # load pa_ap_sefms
-    pa_ap_sefms = nb.load(pa_ap_sefms)
+    # load pa_ap_sefms, unless the caller has already done so
+    if pa_ap_sefms_img is None:
+        pa_ap_sefms_img = nb.load(pa_ap_sefms)
+    pa_ap_sefms = pa_ap_sefms_img
+    data = pa_ap_sefms.get_fdata()
 
-    # apply corrections and save in stacked image
-    pa_ap_sefms_gdc_dc = [
-        topup_gdc_dc_moco[n].apply_to_array(
-            data=pa_ap_sefms.get_fdata()[:, :, :, n],
+    # apply corrections directly into a stacked array, correcting
+    # both volumes concurrently (scipy's interpolation releases the GIL)
+    pa_ap_sefms_gdc_dc = np.empty(pa_ap_sefms.shape, dtype=np.float32)
+
+    def correct_volume(n):
+        pa_ap_sefms_gdc_dc[..., n] = topup_gdc_dc_moco[n].apply_to_array(
+            data=data[:, :, :, n],
             src=pa_ap_sefms,
             ref=pa_ap_sefms,
             order=interpolation,
         )
-        for n in range(0, 2)
-    ]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(correct_volume, range(0, 2)))
     pa_ap_sefms_gdc_dc = nb.nifti1.Nifti1Image(
-        np.concatenate([arr[..., np.newaxis] for arr in pa_ap_sefms_gdc_dc], axis=-1),
-        affine=pa_ap_sefms.affine,
+        pa_ap_sefms_gdc_dc, affine=pa_ap_sefms.affine
     )
     return pa_ap_sefms_gdc_dc
 
@@ -150,6 +162,7 @@ def generate_fmaps(
     logging.info(f"Interpolation order: {interpolation}")
 
     # apply gradient distortion correction to stacked SEFMs
+    pa_ap_sefms_img = nb.load(pa_ap_sefms)
     if gd_corr:
         gdc = rt.NonLinearRegistration.from_fnirt(
             coefficients=gdc_warp,
@@ -158,10 +171,10 @@ def generate_fmaps(
             intensity_correct=True,
         )
         topup_input_pa_ap_sefms = gdc.apply_to_image(
-            src=pa_ap_sefms, ref=pa_ap_sefms, order=interpolation, cores=1
+            src=pa_ap_sefms_img, ref=pa_ap_sefms, order=interpolation, cores=1
         )
     else:
-        topup_input_pa_ap_sefms = nb.load(pa_ap_sefms)
+        topup_input_pa_ap_sefms = pa_ap_sefms_img
     topup_input_pa_ap_sefms_name = distcorr_dir / "merged_sefms_topup_input.nii.gz"
     nb.save(topup_input_pa_ap_sefms, topup_input_pa_ap_sefms_name)
 
@@ -189,8 +202,8 @@ def generate_fmaps(
     # Convert fmap from Hz to rad/s
     logging.info("Converting fieldmap from Hz to rad/s.")
     fmap_spc = rt.ImageSpace(topup_fmap)
-    fmap_arr_hz = nb.load(topup_fmap).get_fdata()
-    fmap_arr = fmap_arr_hz * 2 * np.pi
+    fmap_arr = nb.load(topup_fmap).get_fdata(caching="unchanged")
+    fmap_arr *= 2 * np.pi
     fmap_spc.save_image(fmap_arr, fmap)
 
     # Apply gdc warp from gradient_unwarp and topup's EPI-DC
@@ -204,6 +217,7 @@ def generate_fmaps(
         gdc_warp,
         interpolation=interpolation,
         gd_corr=gd_corr,
+        pa_ap_sefms_img=pa_ap_sefms_img,
     )
 
     # Mean across volumes of corrected sefms to get fmapmag
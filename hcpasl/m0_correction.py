@@ -4,14 +4,16 @@ Magnetisation Transfer effect visible in the HCP data.
 """
 import logging
 import os.path as op
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import partial
 
 import nibabel as nb
 import numpy as np
 import regtricks as rt
 
 from .tissue_masks import generate_tissue_mask
-from .utils import sp_run
+from .utils import sp_run, split_thread_env
 
 
 def generate_asl2struct(asl_vol0, struct, fsdir, reg_dir):
@@ -81,6 +83,180 @@ def generate_asl2struct(asl_vol0, struct, fsdir, reg_dir):
     np.savetxt(op.join(reg_dir, "asl2struct.mat"), asl2struct_fsl)
 
 
+def _correct_calib(
+    calib_name,
+    gdc_warp,
+    epi_dc_warp,
+    bbr_fmap2struct,
+    fmapmag,
+    struct_name,
+    fsdir,
+    t1w_dir,
+    mt_sfs,
+    wmparc,
+    ribbon,
+    corticallut,
+    subcorticallut,
+    interpolation=3,
+    nobandingcorr=False,
+    gd_corr=True,
+    thread_env=None,
+):
+    """
+    Apply the corrections described in `correct_M0` to a single
+    calibration image. `mt_sfs` are the float32 MT scaling factors,
+    or None if banding corrections are switched off. `thread_env`
+    holds thread-count overrides for the FSL tools run for this image.
+
+    The regtricks transforms cache their resolved fields while being
+    applied, so each concurrent call must be given its own copies.
+    """
+    thread_env = {} if thread_env is None else thread_env
+    # get calib_dir and other info
+    calib_dir = calib_name.parent
+    calib_name_stem = calib_name.stem.split(".")[0]
+    logging.info(f"Processing {calib_name_stem}.")
+    distcorr_dir = calib_dir / "DistCorr"
+    distcorr_dir.mkdir(exist_ok=True, parents=True)
+
+    # apply gdc to the calibration image
+    if gd_corr:
+        logging.info(f"Applying gradient distortion correction to {calib_name_stem}.")
+        calib_img = gdc_warp.apply_to_image(calib_name, calib_name, order=interpolation)
+        calib_name_stem = "gdc_" + calib_name_stem
+        calib_corr_name = distcorr_dir / f"{calib_name_stem}.nii.gz"
+        nb.save(calib_img, calib_corr_name)
+    else:
+        calib_corr_name = calib_name
+        calib_img = nb.load(calib_corr_name)
+
+    # apply mt scaling factors to the (potentially) gradient distortion-corrected calibration image
+    if not nobandingcorr:
+        logging.info(f"Applying MT scaling factors to {calib_name_stem}.")
+        assert len(mt_sfs) == calib_img.shape[2]
+        mt_gdc_calib_img = nb.nifti1.Nifti1Image(
+            calib_img.get_fdata(dtype=np.float32) * mt_sfs,
+            calib_img.affine,
+        )
+        mtcorr_dir = calib_dir / "MTCorr"
+        mtcorr_dir.mkdir(exist_ok=True, parents=True)
+        calib_name_stem = "mtcorr_" + calib_name_stem
+        calib_corr_name = mtcorr_dir / f"{calib_name_stem}.nii.gz"
+        nb.save(mt_gdc_calib_img, calib_corr_name)
+
+    # get registration to structural
+    logging.info("Generate registration to structural.")
+    generate_asl2struct(calib_corr_name, struct_name, fsdir, distcorr_dir)
+    asl2struct_reg = rt.Registration.from_flirt(
+        src2ref=distcorr_dir / "asl2struct.mat",
+        src=calib_corr_name,
+        ref=struct_name,
+    )
+    # invert for struct2calib registration
+    struct2calib_reg = asl2struct_reg.inverse()
+    struct2calib_name = distcorr_dir / "struct2asl.mat"
+    np.savetxt(
+        struct2calib_name,
+        struct2calib_reg.to_flirt(struct_name, calib_corr_name),
+    )
+
+    # now that we have registrations from calib2str and fmap2str, use
+    # this to apply gdc, epidc and MT correction to the calibration image
+    # apply distortion corrections
+    calib_name_stem = calib_name_stem.split("_")[-1]
+    logging.info(f"Applying distortion corrections to {calib_name_stem}.")
+    fmap2calib_reg = rt.chain(bbr_fmap2struct, struct2calib_reg)
+    dc_calibspc_warp = rt.chain(fmap2calib_reg.inverse(), epi_dc_warp, fmap2calib_reg)
+    if gd_corr:
+        dc_calibspc_warp = rt.chain(gdc_warp, dc_calibspc_warp)
+        calib_name_stem = "gdc_dc_" + calib_name_stem
+    else:
+        calib_name_stem = "dc_" + calib_name_stem
+    dc_calib_name = distcorr_dir / f"{calib_name_stem}.nii.gz"
+    dc_calib = dc_calibspc_warp.apply_to_image(
+        src=calib_name, ref=calib_name, order=interpolation
+    )
+    nb.save(dc_calib, dc_calib_name)
+
+    # register fmapmag to calibration image space to perform SE-based bias estimation
+    logging.info(f"Registering {fmapmag.stem} to {calib_name_stem}")
+    fmapmag_calibspc = fmap2calib_reg.apply_to_image(
+        fmapmag, calib_name, order=interpolation
+    )
+    biascorr_dir = calib_dir / "BiasCorr"
+    sebased_dir = biascorr_dir / "SEbased"
+    sebased_dir.mkdir(parents=True, exist_ok=True)
+    fmapmag_cspc_name = sebased_dir / f"fmapmag_{calib_name_stem}spc.nii.gz"
+    nb.save(fmapmag_calibspc, fmapmag_cspc_name)
+
+    # get brain mask in calibration image space
+    logging.info("Getting brain mask in calibration image space.")
+    fs_brainmask = (t1w_dir / "brainmask_fs.nii.gz").resolve(strict=True)
+    aslfs_mask_name = calib_dir / "aslfs_mask.nii.gz"
+    aslfs_mask = struct2calib_reg.apply_to_image(
+        src=fs_brainmask, ref=calib_name, order=1
+    )
+    aslfs_mask = nb.nifti1.Nifti1Image(
+        (aslfs_mask.get_fdata() > 0.5).astype(np.float32), affine=dc_calib.affine
+    )
+    nb.save(aslfs_mask, aslfs_mask_name)
+
+    # get sebased bias estimate
+    sebased_cmd = [
+        "get_sebased_bias_asl",
+        "-i",
+        dc_calib_name,
+        "-f",
+        fmapmag_cspc_name,
+        "-m",
+        aslfs_mask_name,
+        "-o",
+        sebased_dir,
+        "--ribbon",
+        ribbon,
+        "--wmparc",
+        wmparc,
+        "--corticallut",
+        corticallut,
+        "--subcorticallut",
+        subcorticallut,
+        "--struct2calib",
+        struct2calib_name,
+        "--structural",
+        struct_name,
+        "--debug",
+    ]
+    logging.info(f"Running SE-based bias estimation on {calib_name_stem}.")
+    sp_run(sebased_cmd, env=thread_env)
+
+    # apply dilall to bias estimate
+    bias_name = sebased_dir / "sebased_bias_dil.nii.gz"
+    dilall_name = biascorr_dir / f"{calib_name_stem}_bias.nii.gz"
+    dilall_cmd = ["fslmaths", bias_name, "-dilall", dilall_name]
+    sp_run(dilall_cmd, env=thread_env)
+
+    # bias correct and mt correct the distortion corrected calib image
+    logging.info(f"Performing bias correction.")
+    bias_img = nb.load(dilall_name)
+    # dc_calib has already been saved and only its affine is used below,
+    # so its data is consumed here: if it is already float32, get_fdata
+    # returns dc_calib's own array and the division below modifies it
+    bc_calib_arr = dc_calib.get_fdata(caching="unchanged", dtype=np.float32)
+    bc_calib_arr /= bias_img.get_fdata(caching="unchanged", dtype=np.float32)
+    bc_calib = nb.nifti1.Nifti1Image(bc_calib_arr, dc_calib.affine)
+    biascorr_name = biascorr_dir / f"{calib_name_stem}_restore.nii.gz"
+    nb.save(bc_calib, biascorr_name)
+
+    if not nobandingcorr:
+        logging.info(f"Performing MT correction.")
+        mt_bc_calib = nb.nifti1.Nifti1Image(
+            bc_calib_arr * mt_sfs,
+            bc_calib.affine,
+        )
+        mtcorr_name = mtcorr_dir / f"mtcorr_{calib_name_stem}_restore.nii.gz"
+        nb.save(mt_bc_calib, mtcorr_name)
+
+
 def correct_M0(
     subject_dir,
     calib_dir,
@@ -191,6 +367,7 @@ def correct_M0(
         logging.info(
             f"gradient_unwarp.py was not run, not applying gradient distortion correction."
         )
+        gdc_warp = None
     fmap, fmapmag, fmapmagbrain = [
         topup_dir / f"fmap{ext}.nii.gz" for ext in ("", "mag", "magbrain")
     ]
@@ -204,7 +381,7 @@ def correct_M0(
     # register fieldmapmag to structural image for use in SE-based later
     logging.info("Getting registration from fmapmag image to structural image.")
     fmap_struct_dir = topup_dir / "fmap_struct_reg"
-    Path(fmap_struct_dir).mkdir(exist_ok=True, parents=True)
+    fmap_struct_dir.mkdir(exist_ok=True, parents=True)
     fsdir = (t1w_dir / subject_dir.stem).resolve(strict=True)
     generate_asl2struct(fmapmag, struct_name, fsdir, fmap_struct_dir)
     logging.info("Loading registration from fieldmap to struct.")
@@ -212,151 +389,37 @@ def correct_M0(
         fmap_struct_dir / "asl2struct.mat", src=fmapmag, ref=struct_name
     )
 
-    # iterate over the two calibration images, applying the corrections to both
-    logging.info("Iterating over subject's calibration images.")
-    for calib_name in (calib0, calib1):
-        # get calib_dir and other info
-        calib_dir = calib_name.parent
-        calib_name_stem = calib_name.stem.split(".")[0]
-        logging.info(f"Processing {calib_name_stem}.")
-        distcorr_dir = calib_dir / "DistCorr"
-        distcorr_dir.mkdir(exist_ok=True, parents=True)
-
-        # apply gdc to the calibration image
-        if gd_corr:
-            logging.info(
-                f"Applying gradient distortion correction to {calib_name_stem}."
-            )
-            calib_img = gdc_warp.apply_to_image(
-                calib_name, calib_name, order=interpolation
-            )
-            calib_name_stem = "gdc_" + calib_name_stem
-            calib_corr_name = distcorr_dir / f"{calib_name_stem}.nii.gz"
-            nb.save(calib_img, calib_corr_name)
-        else:
-            calib_corr_name = calib_name
-            calib_img = nb.load(calib_corr_name)
-
-        # apply mt scaling factors to the (potentially) gradient distortion-corrected calibration image
-        if not nobandingcorr:
-            logging.info(f"Applying MT scaling factors to {calib_name_stem}.")
-            mt_sfs = np.loadtxt(mt_factors)
-            assert len(mt_sfs) == calib_img.shape[2]
-            mt_gdc_calib_img = nb.nifti1.Nifti1Image(
-                calib_img.get_fdata() * mt_sfs, calib_img.affine
-            )
-            mtcorr_dir = calib_dir / "MTCorr"
-            mtcorr_dir.mkdir(exist_ok=True, parents=True)
-            calib_name_stem = "mtcorr_" + calib_name_stem
-            calib_corr_name = mtcorr_dir / f"{calib_name_stem}.nii.gz"
-            nb.save(mt_gdc_calib_img, calib_corr_name)
-
-        # get registration to structural
-        logging.info("Generate registration to structural.")
-        generate_asl2struct(calib_corr_name, struct_name, fsdir, distcorr_dir)
-        asl2struct_reg = rt.Registration.from_flirt(
-            src2ref=distcorr_dir / "asl2struct.mat",
-            src=calib_corr_name,
-            ref=struct_name,
-        )
-        # invert for struct2calib registration
-        struct2calib_reg = asl2struct_reg.inverse()
-        struct2calib_name = distcorr_dir / "struct2asl.mat"
-        np.savetxt(
-            struct2calib_name,
-            struct2calib_reg.to_flirt(struct_name, calib_corr_name),
-        )
-
-        # now that we have registrations from calib2str and fmap2str, use
-        # this to apply gdc, epidc and MT correction to the calibration image
-        # apply distortion corrections
-        calib_name_stem = calib_name_stem.split("_")[-1]
-        logging.info(f"Applying distortion corrections to {calib_name_stem}.")
-        fmap2calib_reg = rt.chain(bbr_fmap2struct, struct2calib_reg)
-        dc_calibspc_warp = rt.chain(
-            fmap2calib_reg.inverse(), epi_dc_warp, fmap2calib_reg
-        )
-        if gd_corr:
-            dc_calibspc_warp = rt.chain(gdc_warp, dc_calibspc_warp)
-            calib_name_stem = "gdc_dc_" + calib_name_stem
-        else:
-            calib_name_stem = "dc_" + calib_name_stem
-        dc_calib_name = distcorr_dir / f"{calib_name_stem}.nii.gz"
-        dc_calib = dc_calibspc_warp.apply_to_image(
-            src=calib_name, ref=calib_name, order=interpolation
-        )
-        nb.save(dc_calib, dc_calib_name)
-
-        # register fmapmag to calibration image space to perform SE-based bias estimation
-        logging.info(f"Registering {fmapmag.stem} to {calib_name_stem}")
-        fmapmag_calibspc = fmap2calib_reg.apply_to_image(
-            fmapmag, calib_name, order=interpolation
-        )
-        biascorr_dir = calib_dir / "BiasCorr"
-        sebased_dir = biascorr_dir / "SEbased"
-        sebased_dir.mkdir(parents=True, exist_ok=True)
-        fmapmag_cspc_name = sebased_dir / f"fmapmag_{calib_name_stem}spc.nii.gz"
-        nb.save(fmapmag_calibspc, fmapmag_cspc_name)
-
-        # get brain mask in calibration image space
-        logging.info("Getting brain mask in calibration image space.")
-        fs_brainmask = (t1w_dir / "brainmask_fs.nii.gz").resolve(strict=True)
-        aslfs_mask_name = calib_dir / "aslfs_mask.nii.gz"
-        aslfs_mask = struct2calib_reg.apply_to_image(
-            src=fs_brainmask, ref=calib_name, order=1
-        )
-        aslfs_mask = nb.nifti1.Nifti1Image(
-            (aslfs_mask.get_fdata() > 0.5).astype(np.float32), affine=dc_calib.affine
-        )
-        nb.save(aslfs_mask, aslfs_mask_name)
-
-        # get sebased bias estimate
-        sebased_cmd = [
-            "get_sebased_bias_asl",
-            "-i",
-            dc_calib_name,
-            "-f",
-            fmapmag_cspc_name,
-            "-m",
-            aslfs_mask_name,
-            "-o",
-            sebased_dir,
-            "--ribbon",
-            ribbon,
-            "--wmparc",
-            wmparc,
-            "--corticallut",
-            corticallut,
-            "--subcorticallut",
-            subcorticallut,
-            "--struct2calib",
-            struct2calib_name,
-            "--structural",
-            struct_name,
-            "--debug",
+    # load MT scaling factors once for both calibration images
+    mt_sfs = None if nobandingcorr else np.loadtxt(mt_factors).astype(np.float32)
+
+    # process the two calibration images concurrently, applying the
+    # corrections to both
+    logging.info("Processing subject's calibration images.")
+    correct_calib = partial(
+        _correct_calib,
+        fmapmag=fmapmag,
+        struct_name=struct_name,
+        fsdir=fsdir,
+        t1w_dir=t1w_dir,
+        mt_sfs=mt_sfs,
+        wmparc=wmparc,
+        ribbon=ribbon,
+        corticallut=corticallut,
+        subcorticallut=subcorticallut,
+        interpolation=interpolation,
+        nobandingcorr=nobandingcorr,
+        gd_corr=gd_corr,
+        thread_env=split_thread_env(2),
+    )
+    # the transforms are stateful, so the second worker gets its own
+    # copies, taken before the first worker starts using the originals
+    calib1_warps = deepcopy((gdc_warp, epi_dc_warp, bbr_fmap2struct))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                correct_calib, calib0, gdc_warp, epi_dc_warp, bbr_fmap2struct
+            ),
+            executor.submit(correct_calib, calib1, *calib1_warps),
         ]
-        logging.info(f"Running SE-based bias estimation on {calib_name_stem}.")
-        sp_run(sebased_cmd)
-
-        # apply dilall to bias estimate
-        bias_name = sebased_dir / "sebased_bias_dil.nii.gz"
-        dilall_name = biascorr_dir / f"{calib_name_stem}_bias.nii.gz"
-        dilall_cmd = ["fslmaths", bias_name, "-dilall", dilall_name]
-        sp_run(dilall_cmd)
-
-        # bias correct and mt correct the distortion corrected calib image
-        logging.info(f"Performing bias correction.")
-        bias_img = nb.load(dilall_name)
-        bc_calib = nb.nifti1.Nifti1Image(
-            dc_calib.get_fdata() / bias_img.get_fdata(), dc_calib.affine
-        )
-        biascorr_name = biascorr_dir / f"{calib_name_stem}_restore.nii.gz"
-        nb.save(bc_calib, biascorr_name)
-
-        if not nobandingcorr:
-            logging.info(f"Performing MT correction.")
-            mt_bc_calib = nb.nifti1.Nifti1Image(
-                bc_calib.get_fdata() * mt_sfs, bc_calib.affine
-            )
-            mtcorr_name = mtcorr_dir / f"mtcorr_{calib_name_stem}_restore.nii.gz"
-            nb.save(mt_bc_calib, mtcorr_name)
+        for future in futures:
+            future.result()
@@ -55,6 +55,11 @@ FS_LUT = {
     255: "WM",  # CC
 }
 
+# FS_LUT as a (label, [GM, WM]) lookup table. The final row is zero
+# and is used for any label beyond those in FS_LUT.
+FS_TISSUE_LUT = np.zeros((max(FS_LUT) + 2, 2), dtype=np.float32)
+FS_TISSUE_LUT[list(FS_LUT), [["GM", "WM"].index(t) for t in FS_LUT.values()]] = 1
+
 
 def pvs_from_freesurfer(t1_dir, ref_spc, ref2struct=None, cores=1):
     """
@@ -100,12 +105,9 @@ def pvs_from_freesurfer(t1_dir, ref_spc, ref2struct=None, cores=1):
     else:
         struct2ref_reg = rt.Registration.identity()
 
-    # Extract PVs from aparcseg segmentation, ignoring cortex.
-    non_cortex_pvs = np.zeros((*aseg_spc.size, 2), dtype=np.float32)
-    for k, t in FS_LUT.items():
-        m = aseg == k
-        idx = ["GM", "WM"].index(t)
-        non_cortex_pvs[m, idx] = 1
+    # Extract PVs from aparcseg segmentation, ignoring cortex, by
+    # looking up every voxel's label in FS_TISSUE_LUT.
+    non_cortex_pvs = np.take(FS_TISSUE_LUT, aseg, axis=0, mode="clip")
 
     # Super-resolution resampling for the vol_pvs, a la applywarp.
     # 0: GM, 1: WM, always in the LAST dimension of an array
@@ -121,24 +123,28 @@ def pvs_from_freesurfer(t1_dir, ref_spc, ref2struct=None, cores=1):
         **surf_dict,
     )
 
-    out = non_cortex_pvs[..., :2].copy()
-
-    # Voxels where toblerone has identified the cortex
+    # Voxels where toblerone has identified the cortex. The cortical and
+    # non-cortical PVs of these voxels are gathered once and layered
+    # together, then written back into the non-cortical PVs in one go.
     ctx = cortex[..., 0] > 0.01
+    ctx_pvs = cortex[ctx, :2]
+    non_ctx_pvs = non_cortex_pvs[ctx, :2]
 
     # total brain PV in these voxels (GM or WM)
-    ctx_brain_pv = np.maximum(cortex[ctx, :2].sum(-1), non_cortex_pvs[ctx, :2].sum(-1))
+    ctx_brain_pv = np.maximum(ctx_pvs.sum(-1), non_ctx_pvs.sum(-1))
 
     # Layer in cortical GM (sum on top of existing GM)
-    out[ctx, 0] = np.minimum(cortex[ctx, 0] + out[ctx, 0], 1)
+    ctx_gm = np.minimum(ctx_pvs[:, 0] + non_ctx_pvs[:, 0], 1)
 
     # In those voxels, the total brain PV be as predicted by Toblerone,
     # so update the WM value based on this
-    out[ctx, 1] = np.maximum(ctx_brain_pv - out[ctx, 0], 0)
+    out = non_cortex_pvs[..., :2]
+    out[ctx, 0] = ctx_gm
+    out[ctx, 1] = np.maximum(ctx_brain_pv - ctx_gm, 0)
 
     # Sanity checks
-    assert (out >= 0).all(), "Negative PV"
-    assert (out <= 1).all(), "PV > 1"
+    assert out.min() >= 0, "Negative PV"
+    assert out.max() <= 1, "PV > 1"
     assert out.sum(-1).max() <= 1.001, "PV sum > 1"
 
     return ref_spc.make_nifti(out)
@@ -78,6 +78,7 @@ def roi_stats(
     roi_stats_dir,
     territories_atlas,
     territories_labels,
+    thread_env=None,
 ):
     # create directory for results
     roi_stats_dir.mkdir(exist_ok=True, parents=True)
@@ -120,4 +121,4 @@ def roi_stats(
         "--native-pves",
     ]
     logging.info("Running oxford_asl_roi_stats.py with command:")
-    sp_run(cmd)
+    sp_run(cmd, env={} if thread_env is None else thread_env)
@@ -29,10 +29,7 @@ def generate_tissue_mask(aparc_aseg, tissue, erode=False):
     """
     # load aparc_aseg
     aseg = nb.load(aparc_aseg)
-    aseg_data = aseg.get_fdata()
-
-    # create mask
-    mask = np.zeros_like(aseg_data)
+    aseg_data = aseg.get_fdata().astype(np.int32)
 
     # get appropriate labels
     if tissue == "gm":
@@ -40,13 +37,14 @@ def generate_tissue_mask(aparc_aseg, tissue, erode=False):
     else:
         labels = TISSUE_LABELS[tissue]
 
-    # iterate through labels
-    for label in labels:
-        mask = np.where(aseg_data == label, 1.0, mask)
-
-    # invert mask if tissue==gm
+    # build a label lookup table, inverted if tissue==gm
+    lut = np.zeros(max(aseg_data.max(), *labels) + 1)
+    lut[list(labels)] = 1.0
     if tissue == "gm":
-        mask = np.where(mask == 0.0, 1.0, 0.0)
+        lut = 1.0 - lut
+
+    # create mask with a single lookup of every voxel's label
+    mask = lut[aseg_data]
 
     # potential round of eroding
     if erode:
@@ -107,6 +105,6 @@ def generate_tissue_mask_in_ref_space(
 
     # re-binarise
     mask = nb.Nifti1Image(
-        np.where(mask.get_fdata() >= threshold, 1.0, 0.0), affine=mask.affine
+        (mask.get_fdata() >= threshold).astype(np.float64), affine=mask.affine
     )
     return mask
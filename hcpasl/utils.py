@@ -1,5 +1,7 @@
+import argparse
 import json
 import logging
+import multiprocessing as mp
 import os
 import shutil
 import subprocess
@@ -16,6 +18,8 @@ from fsl.wrappers.misc import fslroi
 from . import resources
 
 ASL_SHAPE = (86, 86, 60, 86)
+# environment variables controlling threading in FSL and numerical libraries
+THREAD_ENV_VARS = ("FSL_NUM_THREADS", "OMP_NUM_THREADS", "MKL_NUM_THREADS")
 
 
 def create_dirs(dir_list, parents=True, exist_ok=True):
@@ -186,7 +190,7 @@ def binarise(pve_name, threshold=0.5):
     PVE image.
     """
     pve = Image(str(pve_name))
-    seg = Image(np.where(pve.data > threshold, 1.0, 0.0), header=pve.header)
+    seg = Image((pve.data > threshold).astype(np.float64), header=pve.header)
     return seg
 
 
@@ -351,3 +355,38 @@ def get_roi_stats_script():
     if not roi_script_name.exists():
         raise RuntimeError("Cannot find oxford_asl_roi_stats within $FSLDIR")
     return roi_script_name
+
+
+def split_thread_env(n_legs):
+    """
+    Environment overrides which share a thread budget between
+    `n_legs` child processes that are run concurrently, for use
+    as `sp_run(cmd, env=...)`.
+
+    Each of the THREAD_ENV_VARS already set in the environment is
+    divided between the legs; unset variables are left to the
+    tools' own defaults.
+    """
+    return {
+        var: str(max(1, int(os.environ[var]) // n_legs))
+        for var in THREAD_ENV_VARS
+        if os.environ.get(var, "").isdigit()
+    }
+
+
+# number of cores available, queried once for --cores validation
+_NCORES = mp.cpu_count()
+
+
+def core_count(value):
+    """
+    argparse type for --cores options: an integer between 1 and
+    the number of cores available on this machine.
+
+    Used instead of `choices=range(...)` so that --help doesn't
+    list every valid core count.
+    """
+    cores = int(value)
+    if not 1 <= cores <= _NCORES:
+        raise argparse.ArgumentTypeError(f"must be between 1 and {_NCORES}")
+    return cores
@@ -7,6 +7,7 @@ from pathlib import Path
 import numpy as np
 
 from hcpasl.MTEstimation import estimate_mt, setup_mtestimation
+from hcpasl.utils import core_count
 
 TR = 8
 ROIS = {
@@ -69,8 +70,8 @@ def main():
         "--cores",
         help="Number of cores to use. Default is 1.",
         default=1,
-        type=int,
-        choices=range(1, mp.cpu_count() + 1),
+        type=core_count,
+        metavar="N",
     )
     parser.add_argument(
         "--interpolation",
@@ -138,6 +139,7 @@ def main():
         method=args.method,
         outdir=args.out,
         ignore_dropouts=args.ignore_dropouts,
+        cores=args.cores,
     )
     for error in errors:
         print(error)
@@ -10,7 +10,8 @@ name of the MT correction scaling factors image.
 import argparse
 import logging
 import os
-from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from shutil import copy, rmtree
 
@@ -23,9 +24,22 @@ from hcpasl.key_outputs import copy_key_outputs
 from hcpasl.m0_correction import correct_M0
 from hcpasl.pv_estimation import run_pv_estimation
 from hcpasl.qc import create_qc_report, roi_stats
-from hcpasl.utils import (copy_oxford_asl_inputs, create_dirs,
-                          get_package_data_name, get_roi_stats_script,
-                          setup_logger, sp_run, split_mbpcasl)
+from hcpasl.utils import (THREAD_ENV_VARS, copy_oxford_asl_inputs, core_count,
+                          create_dirs, get_package_data_name,
+                          get_roi_stats_script, setup_logger, sp_run,
+                          split_mbpcasl, split_thread_env)
+
+
+def get_freesurfer_luts():
+    """
+    Locate the cortical and subcortical FreeSurfer label tables
+    distributed with the HCP Pipelines ($HCPPIPEDIR).
+    """
+    config_dir = Path(os.environ["HCPPIPEDIR"]) / "global/config"
+    return [
+        config_dir / f"FreeSurfer{region}LabelTableLut.txt"
+        for region in ("Cortical", "Subcortical")
+    ]
 
 
 def process_subject(
@@ -156,9 +170,7 @@ def process_subject(
         )
 
     # apply corrections to the calibration images
-    hcppipedir = Path(os.environ["HCPPIPEDIR"])
-    corticallut = hcppipedir / "global/config/FreeSurferCorticalLabelTableLut.txt"
-    subcorticallut = hcppipedir / "global/config/FreeSurferSubcorticalLabelTableLut.txt"
+    corticallut, subcorticallut = get_freesurfer_luts()
     t1w_dir = structural["struct"].parent
     if 2 in stages:
         logging.info("Stage 2: correct M0 image.")
@@ -307,19 +319,23 @@ def process_subject(
         run_pv_estimation(studydir, subid, cores, outdir, interpolation)
 
     # perform tag-control subtraction in ASLT1w space
-    aslt1w_dir = aslt1w_dir
     series = aslt1w_dir / "TIs/asl_corr.nii.gz"
     scaling_factors = aslt1w_dir / "TIs/combined_scaling_factors.nii.gz"
     betas_dir = aslt1w_dir / "TIs/MotionSubtraction"
     brainmask = aslt1w_dir / "TIs/reg/brain_fov_mask.nii.gz"
+    beta_perf = betas_dir / "beta_perf.nii.gz"
     if 8 in stages:
         logging.info("Stage 8: Label-control subtraction in ASLT1w space")
         tag_control_differencing(series, scaling_factors, betas_dir, mask=brainmask)
-        copy(betas_dir / "beta_perf.nii.gz", aslt1w_dir / "asl_corr_subtracted.nii.gz")
+        copy(beta_perf, aslt1w_dir / "asl_corr_subtracted.nii.gz")
 
     # final perfusion estimation in ASLT1w space
     pve_dir = aslt1w_dir / "PVEs"
     gm_pve, wm_pve = [pve_dir / f"pve_{tiss}.nii.gz" for tiss in ("GM", "WM")]
+    csf_mask = pve_dir / "vent_csf_mask.nii.gz"
+    calib_aslt1w = aslt1w_dir / "Calib/Calib0/calib0_corr.nii.gz"
+    timing_img = aslt1w_dir / "TIs/timing_img_aslt1w.nii.gz"
+    t1_aslt1w = aslt1w_dir / "TIs/reg/mean_T1t_filt_aslt1w.nii.gz"
     oxford_aslt1w_dir = aslt1w_dir / "OxfordASL"
     oxford_aslt1w_dir.mkdir(parents=True, exist_ok=True)
     if 9 in stages:
@@ -328,27 +344,27 @@ def process_subject(
             f"Copying oxford_asl inputs to one location ({str(oxford_aslt1w_dir/'oxford_asl_inputs')})."
         )
         oxasl_inputs = {
-            "-i": betas_dir / "beta_perf.nii.gz",
+            "-i": beta_perf,
             "--pvgm": gm_pve,
             "--pvwm": wm_pve,
-            "--csf": pve_dir / "vent_csf_mask.nii.gz",
-            "-c": aslt1w_dir / "Calib/Calib0/calib0_corr.nii.gz",
-            "-m": aslt1w_dir / "TIs/reg/brain_fov_mask.nii.gz",
-            "--tiimg": aslt1w_dir / "TIs/timing_img_aslt1w.nii.gz",
+            "--csf": csf_mask,
+            "-c": calib_aslt1w,
+            "-m": brainmask,
+            "--tiimg": timing_img,
         }
         if use_t1:
-            oxasl_inputs["--t1im"] = aslt1w_dir / "TIs/reg/mean_T1t_filt_aslt1w.nii.gz"
+            oxasl_inputs["--t1im"] = t1_aslt1w
         copy_oxford_asl_inputs(oxasl_inputs, oxford_aslt1w_dir / "oxford_asl_inputs")
         oxford_aslt1w_call = [
             "oxford_asl",
-            f"-i={str(betas_dir/'beta_perf.nii.gz')}",
+            f"-i={str(beta_perf)}",
             f"-o={str(oxford_aslt1w_dir)}",
             f"--pvgm={str(gm_pve)}",
             f"--pvwm={str(wm_pve)}",
-            f"--csf={str(pve_dir/'vent_csf_mask.nii.gz')}",
-            f"-c={str(aslt1w_dir/'Calib/Calib0/calib0_corr.nii.gz')}",
+            f"--csf={str(csf_mask)}",
+            f"-c={str(calib_aslt1w)}",
             f"-m={str(brainmask)}",
-            f"--tiimg={str(aslt1w_dir/'TIs/timing_img_aslt1w.nii.gz')}",
+            f"--tiimg={str(timing_img)}",
             "--casl",
             "--ibf=tis",
             "--iaf=diff",
@@ -362,27 +378,50 @@ def process_subject(
             "--debug",
         ]
         if use_t1:
-            est_t1 = aslt1w_dir / "TIs/reg/mean_T1t_filt_aslt1w.nii.gz"
-            oxford_aslt1w_call.append(f"--t1im={str(est_t1)}")
+            oxford_aslt1w_call.append(f"--t1im={str(t1_aslt1w)}")
         sp_run(oxford_aslt1w_call)
 
+    # stages 10 and 11 only read the ASLT1w oxford_asl outputs and write
+    # to separate directories, so they can run side by side. The threads
+    # given to FSL tools are shared between the ROI stats and the two
+    # concurrent surface projections.
     mninonlinear_name = subject_dir / "MNINonLinear"
+    thread_env = split_thread_env(max(1, (10 in stages) + 2 * (11 in stages)))
+    post_oxford_stages = []
     if 10 in stages:
         logging.info("Stage 10: Summary statistics within ROIs.")
-        roi_stats(
-            struct_name=structural["struct"],
-            oxford_asl_dir=oxford_aslt1w_dir,
-            gm_pve=gm_pve,
-            wm_pve=wm_pve,
-            std2struct_name=mninonlinear_name / "xfms/standard2acpc_dc.nii.gz",
-            roi_stats_dir=aslt1w_dir / "roi_stats",
-            territories_atlas=territories_atlas,
-            territories_labels=territories_labels,
+        post_oxford_stages.append(
+            partial(
+                roi_stats,
+                struct_name=structural["struct"],
+                oxford_asl_dir=oxford_aslt1w_dir,
+                gm_pve=gm_pve,
+                wm_pve=wm_pve,
+                std2struct_name=mninonlinear_name / "xfms/standard2acpc_dc.nii.gz",
+                roi_stats_dir=aslt1w_dir / "roi_stats",
+                territories_atlas=territories_atlas,
+                territories_labels=territories_labels,
+                thread_env=thread_env,
+            )
         )
 
     if 11 in stages:
         logging.info("Stage 11: Volume to surface projection ")
-        surface_projection_stage(studydir, subid, outdir=outdir)
+        post_oxford_stages.append(
+            partial(
+                surface_projection_stage,
+                studydir,
+                subid,
+                outdir=outdir,
+                thread_env=thread_env,
+            )
+        )
+
+    if post_oxford_stages:
+        with ThreadPoolExecutor(max_workers=len(post_oxford_stages)) as executor:
+            futures = [executor.submit(stage) for stage in post_oxford_stages]
+            for future in futures:
+                future.result()
 
     if 12 in stages:
         logging.info(
@@ -404,6 +443,7 @@ def surface_projection_stage(
     SmoothingFWHM="2",
     GreyOrdsRes="2",
     RegName="MSMAll",
+    thread_env=None,
 ):
     """
     Project perfusion results to the cortical surface and generate
@@ -417,6 +457,10 @@ def surface_projection_stage(
         Path to the study's base directory.
     subid : str
         Subject id for the subject of interest.
+    thread_env : dict, optional
+        Thread count overrides for each of the two concurrent
+        projections, see `split_thread_env`. Default is None,
+        which splits the environment's thread counts between them.
     """
 
     # Projection scripts path:
@@ -436,41 +480,31 @@ def surface_projection_stage(
         "arrival_var",
     ]
 
-    for idx in range(4):
-        non_pvcorr_cmd = [
-            script,
-            str(studydir),
-            subid,
-            ASLVariable[idx],
-            ASLVariableVar[idx],
-            lowresmesh,
-            FinalASLRes,
-            SmoothingFWHM,
-            GreyOrdsRes,
-            RegName,
-            wb_path,
-            "false",
-            str(outdir),
-        ]
+    # only the variable names and the pvcorr flag change between calls
+    mesh_args = [lowresmesh, FinalASLRes, SmoothingFWHM, GreyOrdsRes, RegName, wb_path]
+    studydir, outdir = str(studydir), str(outdir)
 
-        pvcorr_cmd = [
-            script,
-            str(studydir),
-            subid,
-            ASLVariable[idx],
-            ASLVariableVar[idx],
-            lowresmesh,
-            FinalASLRes,
-            SmoothingFWHM,
-            GreyOrdsRes,
-            RegName,
-            wb_path,
-            "true",
-            str(outdir),
-        ]
+    # the two projections share the threads given to FSL/workbench tools
+    if thread_env is None:
+        thread_env = split_thread_env(2)
+
+    def project_variables(pvcorr):
+        for variable, variable_var in zip(ASLVariable, ASLVariableVar):
+            sp_run(
+                [script, studydir, subid, variable, variable_var, *mesh_args]
+                + [pvcorr, outdir],
+                env=thread_env,
+            )
 
-        sp_run(non_pvcorr_cmd)
-        sp_run(pvcorr_cmd)
+    # the non-pvcorr and pvcorr projections write to separate results
+    # directories so can run side by side, whereas the variables within
+    # each share intermediate files so are projected in turn
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(project_variables, pvcorr) for pvcorr in ("false", "true")
+        ]
+        for future in futures:
+            future.result()
 
 
 def copy_outputs(studydir, subid, outdir):
@@ -576,10 +610,12 @@ def main():
     optional.add_argument(
         "--cores",
         help="Number of cores to use when applying motion correction and "
-        + "other multi-core operations. Default is 1.",
-        default=1,
-        type=int,
-        choices=range(1, cpu_count() + 1),
+        + "other multi-core operations. If given, this also sets the "
+        + "FSL/OpenMP/MKL thread counts unless these are already set in "
+        + "the environment. If not given, 1 core is used and the thread "
+        + "counts are left as they are in the environment.",
+        type=core_count,
+        metavar="N",
     )
     optional.add_argument(
         "--interpolation",
@@ -644,54 +680,72 @@ def main():
     logging.info(f"Logging to {log_path}")
 
     # Look for required files in default paths if not provided.
-    if args.struct is None:
-        args.struct = subdir / "T1w/T1w_acpc_dc_restore.nii.gz"
-        logging.info(f"Using default for struct: {args.struct}")
-    if not os.path.exists(args.struct):
-        raise ValueError(f"Path to struct does not exist: {args.struct}")
-
-    if args.sbrain is None:
-        args.sbrain = subdir / "T1w/T1w_acpc_dc_restore_brain.nii.gz"
-        logging.info(f"Using default for sbrain: {args.sbrain}")
-    if not os.path.exists(args.sbrain):
-        raise ValueError(f"Path to sbrain does not exist: {args.sbrain}")
-
-    if args.wmparc is None:
-        args.wmparc = subdir / "T1w/wmparc.nii.gz"
-        logging.info(f"Using default for wmparc: {args.wmparc}")
-    if not os.path.exists(args.wmparc):
-        raise ValueError(f"Path to wmparc does not exist: {args.wmparc}")
-
-    if args.ribbon is None:
-        args.ribbon = subdir / "T1w/ribbon.nii.gz"
-        logging.info(f"Using default for ribbon: {args.ribbon}")
-    if not os.path.exists(args.ribbon):
-        raise ValueError(f"Path to ribbon does not exist: {args.ribbon}")
+    defaults = {
+        "struct": "T1w/T1w_acpc_dc_restore.nii.gz",
+        "sbrain": "T1w/T1w_acpc_dc_restore_brain.nii.gz",
+        "wmparc": "T1w/wmparc.nii.gz",
+        "ribbon": "T1w/ribbon.nii.gz",
+    }
+    for name, default in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, subdir / default)
+            logging.info(f"Using default for {name}: {getattr(args, name)}")
+
+    # Check the input files needed by the selected stages up front, so
+    # that a typo fails in seconds rather than after earlier stages run.
+    if not args.mtname and not args.nobandingcorr:
+        args.mtname = get_package_data_name("scaling_factors.txt")
+    stages = set(args.stages)
+    inputs = {}
+    for names, needed_by in (
+        (("mbpcasl",), {0}),
+        (("fmap_ap", "fmap_pa", "grads"), {1}),
+        (("struct", "sbrain"), {2, 3, 6, 10}),
+        (("wmparc", "ribbon"), {2, 6}),
+        (("mtname",), {2, 3, 6}),
+        (("territories_atlas", "territories_labels"), {10}),
+    ):
+        if stages & needed_by:
+            inputs.update(
+                {name: getattr(args, name) for name in names if getattr(args, name)}
+            )
+    # LUTs are used for SE-based bias correction in stages 2 and 6
+    if stages & {2, 6}:
+        cortical_lut, subcortical_lut = get_freesurfer_luts()
+        inputs.update(
+            {"cortical LUT": cortical_lut, "subcortical LUT": subcortical_lut}
+        )
+    missing = [f"{k}: {v}" for k, v in inputs.items() if not os.path.exists(v)]
+    if missing:
+        raise ValueError("Input files do not exist:\n" + "\n".join(missing))
 
     # parse remaining arguments
-    if args.mtname:
-        mtname = Path(args.mtname).resolve(strict=True)
-    elif not args.nobandingcorr:
-        mtname = get_package_data_name("scaling_factors.txt")
-    else:
-        mtname = None
+    mtname = Path(args.mtname).resolve() if args.mtname else None
     structural = {
-        "struct": Path(args.struct).resolve(strict=True),
-        "sbrain": Path(args.sbrain).resolve(strict=True),
+        "struct": Path(args.struct).resolve(),
+        "sbrain": Path(args.sbrain).resolve(),
     }
-    mbpcasl = Path(args.mbpcasl).resolve(strict=True)
+    mbpcasl = Path(args.mbpcasl).resolve()
     fmaps = {
-        "AP": Path(args.fmap_ap).resolve(strict=True),
-        "PA": Path(args.fmap_pa).resolve(strict=True),
+        "AP": Path(args.fmap_ap).resolve(),
+        "PA": Path(args.fmap_pa).resolve(),
     }
     if args.grads is not None:
-        grads = Path(args.grads).resolve(strict=True)
+        grads = Path(args.grads).resolve()
     else:
         logging.info(
             f"No gradient coefficients provided. Gradient distortion correction won't be performed."
         )
         grads = None
 
+    # share the requested cores with child FSL/fabber processes, without
+    # overriding thread counts already exported by the user
+    if args.cores is None:
+        args.cores = 1
+    else:
+        for thread_var in THREAD_ENV_VARS:
+            os.environ.setdefault(thread_var, str(args.cores))
+
     logging.info("All pipeline arguments:")
     for k, v in vars(args).items():
         logging.info(f"{k}: {v}")
@@ -172,7 +172,7 @@ def se_based_bias_estimation():
     fwhm = 5
     sigma = fwhm / np.sqrt(8 * np.log(2))
     # binarise and smooth the thresholded image
-    SEdivM0_brain_thr_roi = np.where(SEdivM0_brain_thr > 0, 1, 0).astype(np.float32)
+    SEdivM0_brain_thr_roi = (SEdivM0_brain_thr > 0).astype(np.float32)
     SEdivM0_brain_thr_s5 = scipy.ndimage.gaussian_filter(SEdivM0_brain_thr, sigma=sigma)
     SEdivM0_brain_thr_roi_s5 = scipy.ndimage.gaussian_filter(
         SEdivM0_brain_thr_roi, sigma=sigma
@@ -222,10 +222,8 @@ def se_based_bias_estimation():
         SEBCdivM0_brain_img.save(SEBCdivM0_brain_name)
 
     # find dropouts
-    Dropouts = np.where(
-        np.logical_and(SEBCdivM0_brain > 0, SEBCdivM0_brain < 0.6), 1, 0
-    )
-    Dropouts_inv = np.where(Dropouts == 1, 0, 1)
+    Dropouts = np.logical_and(SEBCdivM0_brain > 0, SEBCdivM0_brain < 0.6).astype(int)
+    Dropouts_inv = 1 - Dropouts
     if debug:
         savenames = [
             str(outdir / f"{name}.nii.gz") for name in ("Dropouts", "Dropouts_inv")
@@ -259,22 +257,29 @@ def se_based_bias_estimation():
         ]
         # parse LUTs
         c_labels, sc_labels = [parse_LUT(lut) for lut in (corticallut, subcorticallut)]
-        cgm, scgm = [np.zeros(ribbon_aslt1.shape), np.zeros(wmparc_aslt1.shape)]
-        cgm, scgm = [np.zeros(ribbon_aslt1.shape), np.zeros(wmparc_aslt1.shape)]
+        ribbon_data, wmparc_data = [
+            img.get_fdata().ravel() for img in (ribbon_aslt1, wmparc_aslt1)
+        ]
+        cgm = np.zeros(ribbon_data.shape, bool)
+        scgm = np.zeros(wmparc_data.shape, bool)
         for label in c_labels:
-            cgm = np.where(ribbon_aslt1.get_fdata() == label, 1, cgm)
+            cgm[ribbon_data == label] = True
         for label in sc_labels:
-            scgm = np.where(wmparc_aslt1.get_fdata() == label, 1, scgm)
+            scgm[wmparc_data == label] = True
+        cgm, scgm = [cgm.reshape(ribbon_aslt1.shape), scgm.reshape(wmparc_aslt1.shape)]
         if debug:
             savenames = [
                 str(outdir / f"{pre}GreyMatter.nii.gz")
                 for pre in ("Cortical", "Subcortical")
             ]
-            images = [Image(array, header=m0_img.header) for array in (cgm, scgm)]
+            images = [
+                Image(array.astype(np.float64), header=m0_img.header)
+                for array in (cgm, scgm)
+            ]
             [image.save(savename) for image, savename in zip(images, savenames)]
 
         # combine masks
-        tissue_mask = np.where(np.logical_or(cgm == 1, scgm == 1), 1, 0)
+        tissue_mask = (cgm | scgm).astype(np.uint8)
         if debug:
             savename = str(outdir / "AllGreyMatter.nii.gz")
             image = Image(tissue_mask, header=m0_img.header)
@@ -284,7 +289,7 @@ def se_based_bias_estimation():
     M0_grey = np.where(
         np.logical_and(tissue_mask == 1, Dropouts_inv == 1), m0_img.data, 0
     ).astype(np.float32)
-    M0_greyroi = np.where(M0_grey != 0, 1, 0).astype(np.float32)
+    M0_greyroi = (M0_grey != 0).astype(np.float32)
     M0_grey_s5, M0_greyroi_s5 = [
         scipy.ndimage.gaussian_filter(arr, sigma=sigma) for arr in (M0_grey, M0_greyroi)
     ]
@@ -321,7 +326,7 @@ def se_based_bias_estimation():
     M0_bias_raw = M0_bias_raw_img.data
 
     # refine bias field
-    M0_bias_roi = np.where(M0_bias_raw > 0, 1, 0).astype(np.float32)
+    M0_bias_roi = (M0_bias_raw > 0).astype(np.float32)
     M0_bias_raw_s5, M0_bias_roi_s5 = [
         scipy.ndimage.gaussian_filter(array, sigma=sigma)
         for array in (M0_bias_raw, M0_bias_roi)